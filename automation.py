@@ -1,24 +1,46 @@
 import asyncio
 import aiohttp
-import json
-import psycopg2
-from psycopg2 import extras
-from datetime import datetime, timedelta
+import orjson
+import simdjson
+import psycopg
+from psycopg import sql
+from datetime import datetime, timedelta, timezone
 import time
+from collections import namedtuple
 import os
+import re
 import sys
 
+try:
+    # uvloop is a faster drop-in event loop; it isn't available on Windows
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # --- Configuration ---
 # Your database connection string from the environment variable
 DB_CONN_STRING = os.environ.get("DATABASE_URL")
 
 # --- Assumed configuration based on your use case ---
 DAYS = 30  # Number of days to scrape data for
-CONCURRENCY = 5  # Number of concurrent requests
+CONCURRENCY = 32  # Number of concurrent requests
+MAX_RETRIES = 3  # Retries for rate-limited (429) or server error (5xx) responses
+RETRY_BACKOFF = 1.0  # Base delay in seconds, doubled on every retry
+QUEUE_SIZE = 1000  # Max scraped responses waiting to be written to the database
+WRITE_BATCH_SIZE = 5000  # Rows sent to the staging table per COPY
+
+# bookaway_trips columns filled by the importer, in the order rows are built
+TRIP_COLUMNS = """
+    route_url, origin, destination,
+    departure_time, arrival_time, transport_type,
+    duration_min, price, price_inr, currency,
+    travel_date, operator_name, provider
+"""
 
 try:
     # This script now reads from the 'routes_id.json' file directly
-    routes_data = json.load(open("routes_id.json", encoding="utf-8"))
+    with open("routes_id.json", "rb") as f:
+        routes_data = orjson.loads(f.read())
 except FileNotFoundError:
     print("Error: routes_id.json not found. Please create this file.")
     sys.exit(1)
@@ -32,14 +54,34 @@ BROWSER_HEADERS = {
     "referer": "https://www.bookaway.com/",
 }
 
+# Search payload fields that are identical for every request
+SEARCH_PEOPLE = {"adults": 1, "children": 0, "infants": 0, "seniors": 0}
+TRAVEL_OPTIONS = ["bus", "train", "ferry", "minivan", "taxi"]
+# Closes the "date" value that ends every serialized search payload
+PAYLOAD_SUFFIX = b'"}'
+
+# A single reusable simdjson parser. Documents it returns are lazy proxies that
+# are only valid until the next parse, so each response must be fully consumed
+# (see extract_trips) before the coroutine yields back to the event loop.
+json_parser = simdjson.Parser()
+
 # --- Helper Functions ---
-def parse_duration_minutes(v):
-    """
-    Parses a duration string (e.g., '1h 30m') into total minutes.
-    """
-    if not v:
-        return None
-    s = str(v).lower().strip()
+# Accepted duration forms:
+#   'H:MM'                 '1:30' -> 90
+#   bare minutes           '90' -> 90
+#   hours and/or minutes   '1h 30m', '45m', '2h', '2 hours 30 minutes' -> 150
+#     (the old scan gave 120 for the last one), with ',' or '-' between the
+#     parts and an optional unit on the minutes, so '1h30', '1h, 30m' and
+#     '1h-30m' are all 90 (the old scan gave 60, 60 and 30), plus an ignored
+#     trailing seconds part or '.' ('1h 30m 15s' and '1h 30m.' -> 90)
+# Anything else falls back to _scan_duration_minutes.
+_DURATION_RE = re.compile(
+    r"^(\d+):(\d+)$|^(\d+)$"
+    r"|^(?:(\d+)\s*h[a-z]*)?[\s,-]*(?:(\d+)(?!\d)\s*(?:m[a-z]*)?)?(?:[\s,-]*\d+\s*s[a-z]*)?[\s.]*$"
+)
+
+def _scan_duration_minutes(s):
+    """The original find/split duration scan, used when _DURATION_RE doesn't match."""
     total = 0
     h_match = s.find('h')
     m_match = s.find('m')
@@ -56,195 +98,354 @@ def parse_duration_minutes(v):
             pass
     if total > 0:
         return total
-    
+
     hm_match = s.split(':')
     if len(hm_match) == 2:
         try:
             return int(hm_match[0]) * 60 + int(hm_match[1])
         except ValueError:
             pass
-
-    try:
-        num = int(s)
-        return num
-    except ValueError:
-        pass
     return None
 
+def parse_duration_minutes(v):
+    """
+    Parses a duration string (e.g., '1h 30m') into total minutes.
+    """
+    if not v:
+        return None
+    s = str(v).lower().strip()
+    m = _DURATION_RE.match(s)
+    if not m:
+        return _scan_duration_minutes(s)
+    hh, mm, num, hours, mins = m.groups()
+    if hh is not None:
+        return int(hh) * 60 + int(mm)
+    if num is not None:
+        return int(num)
+    total = int(hours or 0) * 60 + int(mins or 0)
+    return total or None
+
 def parse_iso_datetime(dt_str):
     """Parses an ISO 8601 string into a datetime object."""
     try:
-        if dt_str:
-            return datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
+        if not dt_str:
+            return None
+        # Fast path for the API's usual 'YYYY-MM-DDTHH:MM:SS[.fff]Z' shape;
+        # anything else goes through the general parser
+        if (
+            len(dt_str) >= 20 and dt_str[-1] == 'Z' and dt_str.isascii()
+            and dt_str[4] == dt_str[7] == '-' and dt_str[10] == 'T'
+            and dt_str[13] == dt_str[16] == ':'
+            and (len(dt_str) == 20 or (dt_str[19] == '.' and dt_str[20:-1].isdigit()))
+            and dt_str[0:4].isdigit() and dt_str[5:7].isdigit() and dt_str[8:10].isdigit()
+            and dt_str[11:13].isdigit() and dt_str[14:16].isdigit() and dt_str[17:19].isdigit()
+        ):
+            micro = int(dt_str[20:-1].ljust(6, '0')[:6]) if dt_str[19] == '.' else 0
+            return datetime(
+                int(dt_str[0:4]), int(dt_str[5:7]), int(dt_str[8:10]),
+                int(dt_str[11:13]), int(dt_str[14:16]), int(dt_str[17:19]),
+                micro, tzinfo=timezone.utc,
+            )
+        return datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
     except (ValueError, TypeError):
         return None
-    return None
+
+def build_payload_prefix(from_slug, to_slug):
+    """
+    Serializes a route's search payload once, up to the opening quote of the
+    date value. A request body is then prefix + date + PAYLOAD_SUFFIX.
+    """
+    payload = orjson.dumps({
+        "from": {"slug": from_slug, "type": "city"},
+        "to": {"slug": to_slug, "type": "city"},
+        "direction": "one-way",
+        "people": SEARCH_PEOPLE,
+        "travelOptions": TRAVEL_OPTIONS,
+    })
+    return payload[:-1] + b',"date":"'
+
+# Per-route values shared by every date's fetch task, built once in build_route_ctx
+RouteCtx = namedtuple("RouteCtx", "from_city to_city from_slug to_slug url_prefix payload_prefix")
+
+def build_route_ctx(route):
+    """Resolves a routes_id.json entry into the immutable context its fetch tasks share."""
+    from_slug = sys.intern(route["from_slug"])
+    to_slug = sys.intern(route["to_slug"])
+    return RouteCtx(
+        from_city=sys.intern(route["from_title"]),
+        to_city=sys.intern(route["to_title"]),
+        from_slug=from_slug,
+        to_slug=to_slug,
+        url_prefix=f"https://www.bookaway.com/en/travel/{from_slug}/to/{to_slug}/on/",
+        payload_prefix=build_payload_prefix(from_slug, to_slug),
+    )
+
+def extract_trips(raw, ctx, date_str):
+    """
+    Parses a search response and returns its priced trips as bookaway_trips rows.
+    The simdjson document never leaves this function, so the shared parser is
+    free again before the caller awaits anything.
+    """
+    data = json_parser.parse(raw)
+    rows = []
+
+    # Everything that is the same for each trip of the response is resolved once
+    route_url = ctx.url_prefix + date_str
+    from_city = ctx.from_city
+    to_city = ctx.to_city
+    # We need a separate API for currency conversion, but for now we'll just store the original
+    price_inr = 0
+
+    for trip in data.get("results") or []:
+        try:
+            # Extracting data from the Bookaway API response structure
+            price_data = trip.get("price", {})
+            price = price_data.get("value")
+
+            # Reject unpriced trips before parsing anything else
+            if not price or price <= 0:
+                continue
+
+            currency = price_data.get("currencyCode")
+
+            dep_dt = parse_iso_datetime(trip.get("departureDate"))
+            arr_dt = parse_iso_datetime(trip.get("arrivalDate"))
+            
+            duration_str = trip.get("duration")
+            operator_name = trip.get("operator", {}).get("name")
+            transport_type = trip.get("transportType")
+
+            # Rows are stored in bookaway_trips column order, ready for COPY
+            rows.append((
+                route_url,
+                from_city,
+                to_city,
+                dep_dt,
+                arr_dt,
+                transport_type,
+                parse_duration_minutes(duration_str) or 0,
+                price,
+                price_inr,
+                currency,
+                date_str,
+                operator_name,
+                "bookaway",
+            ))
+        except Exception as e:
+            print(f"Error parsing trip data: {e}")
+            continue
+    return rows
 
 # --- Main Scraper & Data Processor ---
-async def fetch_route(session: aiohttp.ClientSession, route, date_str, sem, results):
+async def fetch_route(session: aiohttp.ClientSession, ctx, date_str, sem, queue):
     """
     Fetches data for a single route and date from Bookaway's API.
     """
     async with sem:
-        from_city = route["from_title"]
-        to_city = route["to_title"]
-        from_slug = route["from_slug"]
-        to_slug = route["to_slug"]
-        
-        # Bookaway's API is a POST request with a JSON payload
+        # Bookaway's API is a POST request with a JSON payload; only the date varies per task
         api_url = "https://www.bookaway.com/api/v1/search"
-        payload = {
-            "from": {"slug": from_slug, "type": "city"},
-            "to": {"slug": to_slug, "type": "city"},
-            "date": date_str,
-            "direction": "one-way",
-            "people": {"adults": 1, "children": 0, "infants": 0, "seniors": 0},
-            "travelOptions": ["bus", "train", "ferry", "minivan", "taxi"]
-        }
+        payload = ctx.payload_prefix + date_str.encode() + PAYLOAD_SUFFIX
+
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with session.post(api_url, headers=BROWSER_HEADERS, data=payload) as resp:
+                    status = resp.status
+                    raw = await resp.read() if status == 200 else None
+            except Exception as e:
+                print(f"Error fetching {api_url}: {e}")
+                return
+
+            if raw is not None:
+                break
+            if (status != 429 and status < 500) or attempt == MAX_RETRIES:
+                print(f"Failed for {ctx.from_city} -> {ctx.to_city} on {date_str} with status {status}")
+                return
+            # Back off exponentially before retrying a rate-limited or failed request
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
 
         try:
-            async with session.post(api_url, headers=BROWSER_HEADERS, json=payload) as resp:
-                if resp.status != 200:
-                    print(f"Failed for {from_city} -> {to_city} on {date_str} with status {resp.status}")
-                    return
-                data = await resp.json()
+            rows = extract_trips(raw, ctx, date_str)
         except Exception as e:
-            print(f"Error fetching {api_url}: {e}")
+            print(f"Error parsing response for {ctx.from_city} -> {ctx.to_city} on {date_str}: {e}")
             return
 
-        for trip in data.get("results", []):
-            try:
-                # Extracting data from the Bookaway API response structure
-                price_data = trip.get("price", {})
-                price = price_data.get("value")
-                currency = price_data.get("currencyCode")
-                
-                # We need a separate API for currency conversion, but for now we'll just store the original
-                price_inr = None
-
-                dep_dt = parse_iso_datetime(trip.get("departureDate"))
-                arr_dt = parse_iso_datetime(trip.get("arrivalDate"))
-                
-                duration_str = trip.get("duration")
-                operator_name = trip.get("operator", {}).get("name")
-                transport_type = trip.get("transportType")
-
-                if not price or price <= 0:
-                    continue
-
-                results.append({
-                    "route_url": f"https://www.bookaway.com/en/travel/{from_slug}/to/{to_slug}/on/{date_str}",
-                    "origin": from_city,
-                    "destination": to_city,
-                    "travel_date": date_str,
-                    "departure_time": dep_dt,
-                    "arrival_time": arr_dt,
-                    "transport_type": transport_type,
-                    "duration_min": parse_duration_minutes(duration_str),
-                    "price": price,
-                    "currency": currency,
-                    "price_inr": price_inr,
-                    "operator_name": operator_name,
-                    "provider": "bookaway",
-                })
-            except Exception as e:
-                print(f"Error parsing trip data: {e}")
-                continue
+        if rows:
+            await queue.put(rows)
 
-def get_db_connection():
-    """Establishes and returns a database connection."""
+async def get_db_connection():
+    """Establishes and returns an async database connection."""
     if not DB_CONN_STRING:
         print("Error: DATABASE_URL environment variable is not set.")
         return None
     try:
-        return psycopg2.connect(DB_CONN_STRING)
-    except psycopg2.DatabaseError as e:
+        return await psycopg.AsyncConnection.connect(DB_CONN_STRING)
+    except psycopg.Error as e:
         print(f"Error connecting to the database: {e}")
         return None
 
-async def main():
-    start_time = time.time()
-    print("Scraper started...")
-    
-    results = []
+async def drop_secondary_indexes(cur):
+    """
+    Drops the bookaway_trips indexes that don't back a constraint and returns
+    their definitions so they can be rebuilt once after the bulk load.
+    Dropping and creating indexes needs table ownership, so nothing is dropped
+    when the current role doesn't own the table.
+    """
+    await cur.execute("""
+    SELECT i.relname, pg_get_indexdef(i.oid)
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_class t ON t.oid = x.indrelid
+    WHERE x.indrelid = 'bookaway_trips'::regclass
+      AND pg_has_role(t.relowner, 'USAGE')
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+    """)
+    indexes = await cur.fetchall()
+    for name, _ in indexes:
+        await cur.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier(name)))
+    return [index_def for _, index_def in indexes]
+
+async def create_staging_table(cur):
+    """
+    Creates a temp table with the bookaway_trips columns that is dropped when
+    the transaction ends. Scraped rows are loaded there first, so
+    bookaway_trips is only exclusively locked for the swap once fetching is
+    done. Staging, swap and commit must all happen in one transaction, since
+    a transaction-mode pooler may run the next transaction on a different
+    backend that doesn't have the table.
+    """
+    await cur.execute(f"""
+    CREATE TEMP TABLE bookaway_trips_staging ON COMMIT DROP AS
+    SELECT {TRIP_COLUMNS} FROM bookaway_trips WITH NO DATA
+    """)
+
+async def copy_rows(conn, rows):
+    """Copies a batch of rows into the staging table with COPY FROM STDIN."""
+    async with conn.cursor() as cur:
+        async with cur.copy(f"COPY bookaway_trips_staging ({TRIP_COLUMNS}) FROM STDIN") as copy:
+            for row in rows:
+                await copy.write_row(row)
+
+async def db_writer(queue, conn):
+    """
+    Drains scraped rows from the queue and copies them into the staging table
+    in batches of WRITE_BATCH_SIZE until a None sentinel arrives. Each COPY
+    reports its errors when its batch closes, so a row the staging columns
+    can't accept stops the run while fetching. The staging table has no
+    constraints, so NOT NULL/CHECK violations only show up in the final swap.
+    Returns the number of rows written.
+    """
+    batch = []
+    total = 0
+    while True:
+        rows = await queue.get()
+        if rows is not None:
+            batch.extend(rows)
+        if batch and (rows is None or len(batch) >= WRITE_BATCH_SIZE):
+            await copy_rows(conn, batch)
+            total += len(batch)
+            print(f"Processed {total} records...")
+            batch = []
+        if rows is None:
+            return total
+
+async def scrape(route_ctxs, queue):
+    """Fetches every route for each of the next DAYS days, queueing the scraped rows."""
     sem = asyncio.Semaphore(CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=CONCURRENCY, ttl_dns_cache=300, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+        today = datetime.now()
+        date_strs = [(today + timedelta(days=day_offset)).strftime('%Y-%m-%d') for day_offset in range(DAYS)]
 
-    async with aiohttp.ClientSession() as session:
         tasks = []
-        for route in routes_data:
-            for day_offset in range(DAYS):
-                date_str = (datetime.now() + timedelta(days=day_offset)).strftime('%Y-%m-%d')
-                tasks.append(fetch_route(session, route, date_str, sem, results))
-        
+        for ctx in route_ctxs:
+            for date_str in date_strs:
+                tasks.append(fetch_route(session, ctx, date_str, sem, queue))
+
         print(f"Fetching data for {len(tasks)} routes over {DAYS} days...")
         await asyncio.gather(*tasks)
 
-    # --- Database Insertion Logic ---
-    if not results:
-        print("❌ ERROR: The list of scraped records is empty. No data to insert.")
+async def main():
+    start_time = time.time()
+    print("Scraper started...")
+
+    try:
+        route_ctxs = [build_route_ctx(route) for route in routes_data]
+    except KeyError as e:
+        print(f"Error: an entry in routes_id.json is missing the {e} key.")
+        return
+
+    print("Connecting to the database...")
+    conn = await get_db_connection()
+    if not conn:
         return
 
-    conn = None
     try:
-        print("Connecting to the database...")
-        conn = get_db_connection()
-        if not conn:
-            return
-            
         cur = conn.cursor()
+        await create_staging_table(cur)
 
+        # Trips are written to the staging table while the remaining routes are still being fetched
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        writer = asyncio.create_task(db_writer(queue, conn))
+        fetches = asyncio.create_task(scrape(route_ctxs, queue))
+        await asyncio.wait({fetches, writer}, return_when=asyncio.FIRST_COMPLETED)
+        if writer.done():
+            # The writer only stops early when the database fails; stop scraping too
+            fetches.cancel()
+            await asyncio.gather(fetches, return_exceptions=True)
+            writer.result()
+
+        scrape_error = fetches.exception()
+        if scrape_error:
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+            print(f"Error while scraping: {scrape_error}")
+            return
+
+        await queue.put(None)
+        total = await writer
+
+        if not total:
+            print("❌ ERROR: The list of scraped records is empty. No data to insert.")
+            return
+
+        # The swap ends the same transaction the rows were staged in, and
+        # bookaway_trips is only exclusively locked from here to the commit
         print("Truncating the bookaway_trips table to delete data and reset the ID sequence...")
-        cur.execute("TRUNCATE TABLE bookaway_trips RESTART IDENTITY;")
-        conn.commit()
+        await cur.execute("TRUNCATE TABLE bookaway_trips RESTART IDENTITY;")
+
+        # Secondary indexes are built once at the end instead of updated per row
+        index_defs = await drop_secondary_indexes(cur)
         print("Table successfully truncated and ID sequence reset. ✅")
-        
-        records_to_insert = [
-            (
-                r["route_url"],
-                r["origin"],
-                r["destination"],
-                r["departure_time"],
-                r["arrival_time"],
-                r["transport_type"],
-                r["duration_min"] or 0,
-                r["price"] or 0,
-                r["price_inr"] or 0,
-                r["currency"],
-                r["travel_date"],
-                r["operator_name"],
-                r["provider"]
-            )
-            for r in results if r["price"] is not None and r["price"] > 0
-        ]
-        
-        print(f"Importing {len(records_to_insert)} new records...")
-        
-        chunk_size = 400
-        for i in range(0, len(records_to_insert), chunk_size):
-            chunk = records_to_insert[i:i + chunk_size]
-            extras.execute_values(cur, """
-            INSERT INTO bookaway_trips (
-                route_url, origin, destination,
-                departure_time, arrival_time, transport_type,
-                duration_min, price, price_inr, currency,
-                travel_date, operator_name, provider
-            ) VALUES %s
-            """, chunk, page_size=chunk_size)
-            conn.commit()
-            print(f"Processed {i + len(chunk)} records...")
-        
+
+        print(f"Importing {total} new records...")
+        await cur.execute(f"""
+        INSERT INTO bookaway_trips ({TRIP_COLUMNS})
+        SELECT {TRIP_COLUMNS} FROM bookaway_trips_staging
+        """)
+
+        if index_defs:
+            print(f"Rebuilding {len(index_defs)} indexes...")
+            for index_def in index_defs:
+                await cur.execute(index_def)
+
+        await conn.commit()
+
         end_time = time.time()
         duration = end_time - start_time
-        print(f"✅ Import completed! Imported {len(records_to_insert)} records in {duration:.2f} seconds.")
+        print(f"✅ Import completed! Imported {total} records in {duration:.2f} seconds.")
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         print(f"Error during database operation: {error}")
-        if conn:
-            conn.rollback()
+        await conn.rollback()
     finally:
-        if conn:
-            conn.close()
-            print("Database connection closed. 👋")
+        await conn.close()
+        print("Database connection closed. 👋")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop:
+        uvloop.run(main())
+    else:
+        if sys.platform == "win32":
+            # psycopg's async connections can't run on the default Proactor loop
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        asyncio.run(main())
\ No newline at end of file